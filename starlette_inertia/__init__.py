@@ -1,3 +1,7 @@
-from starlette_inertia.inertia import InertiaMiddleware, InertiaResponse
+from starlette_inertia.inertia import (
+    InertiaMiddleware,
+    InertiaResponse,
+    manifest_version,
+)
 
-__all__ = ["InertiaMiddleware", "InertiaResponse"]
+__all__ = ["InertiaMiddleware", "InertiaResponse", "manifest_version"]
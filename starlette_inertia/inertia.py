@@ -2,9 +2,25 @@
 FastAPI bindings for Inertia.js
 """
 import functools
+import hashlib
+import io
+import os
 import pathlib
 import re
-from typing import Any, Callable, Dict, List, Optional, Union
+import time
+import urllib.parse
+import weakref
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import jinja2
 import starlette
@@ -12,6 +28,148 @@ import starlette.requests
 import starlette.responses
 import starlette.types
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    # Optional, installed with the "fast" extra.
+    orjson = None
+
+# Request headers the middleware needs to route a request.
+_INERTIA_REQUEST_HEADERS = frozenset(
+    (b"x-requested-with", b"x-inertia", b"x-inertia-version")
+)
+_IF_NONE_MATCH = frozenset((b"if-none-match",))
+
+# Methods whose 302 redirects are rewritten to 303, so the browser follows with a GET.
+_REDIRECT_METHODS = frozenset(("PUT", "PATCH", "DELETE"))
+
+# Headers added to every response rendered by the middleware. Any existing values for
+# these are replaced.
+_HTML_RESPONSE_HEADERS = ((b"x-inertia", b"true"), (b"content-type", b"text/html"))
+_JSON_RESPONSE_HEADERS = (
+    (b"x-inertia", b"true"),
+    (b"content-type", b"application/json"),
+)
+# Partial reload headers, responses carrying these don't get Vary: Accept.
+_PARTIAL_HEADERS = frozenset(
+    (b"x-inertia-partial-data", b"x-inertia-partial-component")
+)
+_VARY_ACCEPT = (b"vary", b"Accept")
+_HTML_CACHE_CONTROL = (b"cache-control", b"no-cache, no-store, must-revalidate")
+_REPLACED_RESPONSE_HEADERS = frozenset(key for key, _ in _JSON_RESPONSE_HEADERS)
+# The JSON body is swapped for the rendered page, so its length no longer applies.
+_REPLACED_HTML_RESPONSE_HEADERS = _REPLACED_RESPONSE_HEADERS | {b"content-length"}
+
+# Methods routes.js is served for, anything else is passed through to the app.
+_ROUTES_JS_METHODS = frozenset(("GET", "HEAD"))
+
+# The 409 response sent when the client's asset version is stale.
+_VERSION_CONFLICT_BODY = b"Inertia version does not match"
+_VERSION_CONFLICT_HEADERS = (
+    (b"content-type", b"text/plain; charset=utf-8"),
+    (b"content-length", str(len(_VERSION_CONFLICT_BODY)).encode("latin-1")),
+)
+
+
+def _pick_headers(
+    raw: List[Tuple[bytes, bytes]], wanted: FrozenSet[bytes]
+) -> Dict[bytes, bytes]:
+    """Pull the wanted headers out of a raw ASGI header list in a single pass.
+
+    Header names in ASGI scopes are already lowercased, and values are left as bytes so
+    they can be compared without decoding. As with Headers.get, the first occurrence of
+    a repeated header wins.
+    """
+    picked: Dict[bytes, bytes] = {}
+    for key, value in raw:
+        if key in wanted and key not in picked:
+            picked[key] = value
+    return picked
+
+
+def _prefixes(prefix: Optional[Union[str, Sequence[str]]]) -> Optional[Tuple[str, ...]]:
+    """Normalize a single prefix or a sequence of them into a tuple for startswith."""
+    if prefix is None:
+        return None
+    return (prefix,) if isinstance(prefix, str) else tuple(prefix)
+
+
+def _scope_path(scope: starlette.types.Scope) -> str:
+    """Return the full request path, root_path included, without building a URL.
+
+    Starlette 0.33 and later keep the mount prefix in scope["path"], older versions
+    strip it into root_path only, so it's only prepended when it's missing.
+    """
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if path.startswith(root_path):
+        return path
+    return root_path + path
+
+
+def _route_path(scope: starlette.types.Scope) -> str:
+    """Return the request path relative to root_path, as routes are matched."""
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if root_path and path.startswith(root_path):
+        return path[len(root_path) :]
+    return path
+
+
+def _request_path(request: starlette.requests.Request) -> str:
+    """Return request.url.path, memoized on request.state for the rest of the request."""
+    state = request.scope.setdefault("state", {})
+    path = state.get("inertia_path")
+    if path is None:
+        path = state["inertia_path"] = request.url.path
+    return path
+
+
+@functools.lru_cache(maxsize=None)
+def _bytecode_cache() -> jinja2.BytecodeCache:
+    # Shared by every environment so compiled templates survive worker restarts.
+    # Falls back to Jinja's per-user temp directory when not configured.
+    return jinja2.FileSystemBytecodeCache(
+        directory=os.environ.get("INERTIA_JINJA_CACHE")
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _environment(directory: pathlib.Path) -> jinja2.Environment:
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader([str(directory)]),
+        bytecode_cache=_bytecode_cache(),
+        auto_reload=False,
+    )
+
+
+def _load_template(path: pathlib.Path) -> jinja2.Template:
+    return _environment(path.parent.resolve()).get_template(path.name)
+
+
+def manifest_version(
+    path: Union[str, pathlib.Path],
+    hasher: Callable[[bytes], Any] = hashlib.md5,
+) -> Callable[[], str]:
+    """Build an asset_version callable from a hash of the file at path.
+
+    Typically path is the manifest written by the asset bundler. The file is only
+    re-hashed when its mtime changes, so the common case costs a single stat.
+    """
+    path = pathlib.Path(path)
+    last_mtime: Optional[int] = None
+    last_version = ""
+
+    def version() -> str:
+        nonlocal last_mtime, last_version
+        mtime = os.stat(path).st_mtime_ns
+        if mtime != last_mtime:
+            last_version = hasher(path.read_bytes()).hexdigest()
+            last_mtime = mtime
+        return last_version
+
+    return version
+
 
 class InertiaResponse(starlette.responses.JSONResponse):
     def __init__(self, *args, component: str = None, **kwargs) -> None:
@@ -23,7 +181,8 @@ class InertiaResponse(starlette.responses.JSONResponse):
 
     def render(self, content: Any) -> bytes:
         # Delay rendering until we've gotten the version and url from the request state.
-        # This is done by __call__ (when receiving http.response.start) below.
+        # This is done by __call__ below, before anything is sent, so the page object
+        # is only serialized once.
         self.content = content
         return b""
 
@@ -34,18 +193,11 @@ class InertiaResponse(starlette.responses.JSONResponse):
         send: starlette.types.Send,
     ) -> None:
         request = starlette.requests.Request(scope, receive)
-        await send(
-            {
-                "type": "http.response.start",
-                "status": self.status_code,
-                "headers": self.raw_headers,
-            }
-        )
         content = {
             "component": self.component,
             "version": request.state.inertia_version,
             "props": self.content,
-            "url": request.url.path,
+            "url": _request_path(request),
         }
         if (
             hasattr(request.state, "inertia_props_callback")
@@ -54,15 +206,38 @@ class InertiaResponse(starlette.responses.JSONResponse):
             content["props"] = dict(
                 request.state.inertia_props_callback(request), **self.content
             )
-        if (
-            request.headers.get("x-inertia-partial-component") == content["component"]
-            and "x-inertia-partial-data" in request.headers
-        ):
-            to_return = set(request.headers["x-inertia-partial-data"].split(","))
-            for k in list(content["props"]):
-                if k not in to_return:
-                    del content["props"][k]
-        self.body = super().render(content)
+        # Only dict props can be filtered or hold lazy values, anything else is sent
+        # as-is.
+        if isinstance(content["props"], dict):
+            partial_data = request.headers.get("x-inertia-partial-data")
+            if (
+                partial_data is not None
+                and request.headers.get("x-inertia-partial-component")
+                == content["component"]
+            ):
+                to_return = frozenset(partial_data.split(","))
+                content["props"] = {
+                    k: v for k, v in content["props"].items() if k in to_return
+                }
+            # Callable props are lazy, they're only evaluated if they're being returned.
+            content["props"] = {
+                k: v() if callable(v) else v for k, v in content["props"].items()
+            }
+        if orjson is not None:
+            self.body = orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        else:
+            self.body = super().render(content)
+        # init_headers ran before there was a body, so Content-Length is set here.
+        headers = [(k, v) for k, v in self.raw_headers if k != b"content-length"]
+        headers.append((b"content-length", str(len(self.body)).encode("latin-1")))
+        self.raw_headers = headers
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
         await send({"type": "http.response.body", "body": self.body})
 
         if self.background is not None:
@@ -84,31 +259,65 @@ class InertiaMiddleware:
         props_callback: Optional[
             Callable[[starlette.requests.Request], Dict[str, Any]]
         ] = None,
+        asset_version_ttl: Optional[float] = 1.0,
+        path_prefix: Optional[Union[str, Sequence[str]]] = None,
+        index_cache_size: int = 512,
+        static_prefix: Optional[Union[str, Sequence[str]]] = None,
+        routes_js_url: Optional[str] = "/_inertia/routes.js",
     ) -> None:
         self.app = app
         self.asset_version = asset_version
+        # Callable asset versions are cached for asset_version_ttl seconds, since they
+        # commonly hash files or shell out to git. None caches until refresh_version().
+        self.asset_version_ttl = asset_version_ttl
+        self._cached_version: Optional[str] = None
+        self._cached_version_at = 0.0
+        # The current version and its encoded form, compared against the raw
+        # X-Inertia-Version header bytes. Only re-encoded when the version changes.
+        self._encoded_version: Optional[Tuple[str, bytes]] = None
         self.props_callback = props_callback
         self.paths = None
         if paths is not None:
             self.paths = paths if isinstance(paths, re.Pattern) else re.compile(paths)
+        # Requests outside these prefixes (static files, health checks, APIs) skip the
+        # middleware entirely, so they can't return an InertiaResponse.
+        self.path_prefix = _prefixes(path_prefix)
+        # Requests under these prefixes skip the middleware too, so static assets keep
+        # their upstream caching headers untouched.
+        self.static_prefix = _prefixes(static_prefix)
 
         template_path = pathlib.Path(__file__).parent / "index.html.jinja2"
         if index_template_path is not None:
             template_path = pathlib.Path(index_template_path)
-        with open(template_path) as f:
-            self.template = jinja2.Template(f.read())
+        self.template = _load_template(template_path)
 
         routes_template_path = pathlib.Path(__file__).parent / "routes.js.jinja2"
         if routes_js_template_path is not None:
             routes_template_path = pathlib.Path(routes_js_template_path)
-        with open(routes_template_path) as f:
-            self.routes_template = jinja2.Template(f.read())
+        self.routes_template = _load_template(routes_template_path)
+        # Rendered routes.js and its ETag, keyed by the route map it was rendered from.
+        self._routes_js_cache: Dict[Tuple[Tuple[str, str], ...], Tuple[str, str]] = {}
+        # Where routes.js is served from, so pages can reference it with a cacheable
+        # <script src> rather than inlining it. None inlines it in every page instead.
+        self.routes_js_url = routes_js_url
+        # Rendered routes.js per app, along with the route count it was rendered from
+        # so that adding routes invalidates it without rebuilding the map per request.
+        # Weakly keyed so an id can't be reused by a later app.
+        self._app_routes_js_cache: weakref.WeakKeyDictionary = (
+            weakref.WeakKeyDictionary()
+        )
 
         self.extra_template_data = {
             "scripts": scripts or [],
             "links": links or [],
         }
         # TODO render func to replace the default template logic?
+        # Full page loads mostly re-render identical pages, and only the page object
+        # varies, so cache the rendered HTML per page body. Cleared whenever the asset
+        # version changes.
+        self._render_index = functools.lru_cache(maxsize=index_cache_size)(
+            self._render_index_uncached
+        )
 
     async def __call__(
         self,
@@ -130,90 +339,230 @@ class InertiaMiddleware:
             await self.app(scope, receive, send)
             return
 
-        request = starlette.requests.Request(scope, receive)
-        request.state.inertia_version = self._inertia_version
-        request.state.inertia_props_callback = self.props_callback
-        responder = InertiaResponder(
-            self.app,
-            template=self.template,
-            extra_template_data=self.extra_template_data,
-            rendered_routes_js=self.routes_template.render(
-                routes={r.name: r.path for r in request.app.routes}
-            ),
-        )
-        wrapped_send = functools.partial(responder.send, send=send, request=request)
+        if (
+            self.routes_js_url is not None
+            and _route_path(scope) == self.routes_js_url
+            and scope["method"] in _ROUTES_JS_METHODS
+        ):
+            await self._send_routes_js(scope, receive, send)
+            return
+
+        path = _scope_path(scope)
+        if (self.path_prefix is not None and not path.startswith(self.path_prefix)) or (
+            self.static_prefix is not None and path.startswith(self.static_prefix)
+        ):
+            await self.app(scope, receive, send)
+            return
 
-        if self.paths is not None and not self.paths.match(request.url.path):
+        # InertiaResponse reads these from request.state, even on paths we don't
+        # watch. Write them straight into the scope dict backing request.state.
+        version, encoded_version = self._versions()
+        state = scope.setdefault("state", {})
+        state["inertia_version"] = version
+        state["inertia_props_callback"] = self.props_callback
+        state["inertia_path"] = path
+
+        if self.paths is not None and not self.paths.match(path):
             # Not a path we want to watch, skip it.
             await self.app(scope, receive, send)
             return
 
         method = scope["method"]
-        if request.headers.get("x-requested-with") != "XMLHttpRequest":
-            # Request is not AJAX, so it's probably a regular old browser GET.
-            # Call the endpoint to get the data and then render the HTML.
-            await self.app(
-                scope, receive, functools.partial(wrapped_send, as_html=True)
-            )
-            return
-        else:
-            if not request.headers.get("x-inertia"):
+        headers = _pick_headers(scope["headers"], _INERTIA_REQUEST_HEADERS)
+        # If the request is not AJAX it's probably a regular old browser GET, so call
+        # the endpoint to get the data and then render the HTML.
+        as_html = headers.get(b"x-requested-with") != b"XMLHttpRequest"
+        if not as_html:
+            if not headers.get(b"x-inertia"):
                 response = starlette.responses.PlainTextResponse(
                     "Inertia headers not found.",
                     status_code=400,
                 )
-                await response(scope, receive, wrapped_send)
+                # Plain error responses go out untouched, they aren't Inertia pages.
+                await response(scope, receive, send)
                 return
 
             # Must be an Inertia request
-            server_version = self._inertia_version
-            client_version = request.headers.get("x-inertia-version")
-            if method == "GET" and client_version != server_version:
-                # Version doesn't match, return header telling inertia to refresh
-                response = starlette.responses.PlainTextResponse(
-                    "Inertia version does not match",
-                    status_code=409,
-                    headers={"X-Inertia-Location": str(request.url)},
+            client_version = headers.get(b"x-inertia-version")
+            if method == "GET" and client_version != encoded_version:
+                # Version doesn't match, return header telling inertia to refresh.
+                # The response is always the same shape, so send it directly.
+                # The raw path keeps escaped delimiters like %2F intact, the decoded
+                # path is only quoted when a server doesn't provide it. Mount leaves
+                # raw_path as the full original path, so root_path is only prepended
+                # when it's missing. Dropping CR/LF keeps request data from injecting
+                # extra response headers.
+                raw_path = scope.get("raw_path")
+                if raw_path is not None:
+                    root_path = scope.get("root_path", "")
+                    root_path_raw = urllib.parse.quote(root_path).encode("ascii")
+                    location = raw_path
+                    if not raw_path.startswith(root_path_raw):
+                        location = root_path_raw + raw_path
+                else:
+                    location = urllib.parse.quote(path).encode("ascii")
+                location = location.translate(None, b"\r\n")
+                if scope.get("query_string"):
+                    location += b"?" + scope["query_string"].translate(None, b"\r\n")
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": 409,
+                        "headers": [
+                            *_VERSION_CONFLICT_HEADERS,
+                            (b"x-inertia-location", location),
+                        ],
+                    }
+                )
+                await send(
+                    {"type": "http.response.body", "body": _VERSION_CONFLICT_BODY}
                 )
-                await response(scope, receive, wrapped_send)
                 return
 
-        await self.app(scope, receive, wrapped_send)
+        routes_js, routes_js_etag = self._app_routes_js(scope["app"])
+        routes_url = None
+        if self.routes_js_url is not None:
+            routes_url = f"{scope.get('root_path', '')}{self.routes_js_url}"
+            routes_url += f"?v={routes_js_etag}"
+        responder = InertiaResponder(
+            self.app,
+            send=send,
+            method=method,
+            render_index=self._render_index,
+            rendered_routes_js=routes_js,
+            routes_url=routes_url,
+            as_html=as_html,
+        )
+        await self.app(scope, receive, responder.send)
+
+    async def _send_routes_js(
+        self,
+        scope: starlette.types.Scope,
+        receive: starlette.types.Receive,
+        send: starlette.types.Send,
+    ) -> None:
+        """Serve the rendered routes.js directly, bypassing the app."""
+        routes_js, etag = self._app_routes_js(scope["app"])
+        # Pages reference this with the ETag in the query string, so any change to the
+        # routes changes the URL and it's safe to cache forever. Any other URL has to
+        # be revalidated, or it would keep serving a stale route table.
+        query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        headers = {
+            "ETag": f'"{etag}"',
+            "Cache-Control": (
+                "public, max-age=31536000, immutable"
+                if query.get("v") == [etag]
+                else "no-cache"
+            ),
+        }
+        if_none_match = _pick_headers(scope["headers"], _IF_NONE_MATCH).get(
+            b"if-none-match"
+        )
+        if if_none_match == headers["ETag"].encode("latin-1"):
+            response = starlette.responses.Response(status_code=304, headers=headers)
+        else:
+            response = starlette.responses.Response(
+                routes_js, media_type="application/javascript", headers=headers
+            )
+        await response(scope, receive, send)
+
+    def _render_index_uncached(
+        self, body: bytes, routes_js: str, routes_url: Optional[str]
+    ) -> bytes:
+        # TODO call provided callable if not None, pass in jinja context
+        template_context = {
+            "body": body,
+            "routes_script": routes_js,
+            "routes_url": routes_url,
+        }
+        template_context.update(self.extra_template_data)
+        # Render straight into a bytes buffer rather than building the whole page as a
+        # str and encoding it afterwards.
+        buf = io.BytesIO()
+        self.template.stream(**template_context).dump(buf, encoding="utf-8")
+        return buf.getvalue()
+
+    def _app_routes_js(self, app: starlette.types.ASGIApp) -> Tuple[str, str]:
+        """Return the rendered routes.js for app and its ETag, building them once."""
+        cached = self._app_routes_js_cache.get(app)
+        if cached is not None and cached[0] == len(app.routes):
+            return cached[1]
+        rendered = self._render_routes_js({r.name: r.path for r in app.routes})
+        self._app_routes_js_cache[app] = (len(app.routes), rendered)
+        return rendered
+
+    def _render_routes_js(self, routes: Dict[str, str]) -> Tuple[str, str]:
+        """Render the routes.js template, reusing the output for identical routes."""
+        key = tuple(routes.items())
+        rendered = self._routes_js_cache.get(key)
+        if rendered is None:
+            js = self.routes_template.render(routes=routes)
+            etag = hashlib.blake2b(js.encode(), digest_size=8).hexdigest()
+            rendered = self._routes_js_cache[key] = (js, etag)
+        return rendered
+
+    def refresh_version(self) -> None:
+        """Drop the cached asset version so the next request recomputes it.
+
+        Useful with asset_version_ttl=None, e.g. from a deploy hook.
+        """
+        self._cached_version = None
+
+    def _versions(self) -> Tuple[str, bytes]:
+        """Return the current asset version along with its encoded form."""
+        version = self._inertia_version
+        if self._encoded_version is None or self._encoded_version[0] != version:
+            self._encoded_version = (version, str(version).encode("utf-8"))
+        return self._encoded_version
 
     @property
     def _inertia_version(self) -> str:
-        return (
-            self.asset_version() if callable(self.asset_version) else self.asset_version
-        )
+        if not callable(self.asset_version):
+            return self.asset_version
+        now = time.monotonic()
+        if self._cached_version is None or (
+            self.asset_version_ttl is not None
+            and now - self._cached_version_at >= self.asset_version_ttl
+        ):
+            version = self.asset_version()
+            if version != self._cached_version:
+                self._render_index.cache_clear()
+            self._cached_version = version
+            self._cached_version_at = now
+        return self._cached_version
 
 
 class InertiaResponder:
     def __init__(
         self,
         app: starlette.types.ASGIApp,
-        template: jinja2.Template,
-        extra_template_data: Dict[str, Any],
+        send: starlette.types.Send,
+        method: str,
+        render_index: Callable[[bytes, str, Optional[str]], bytes],
         rendered_routes_js: str,
+        routes_url: Optional[str] = None,
+        as_html: bool = False,
     ) -> None:
         self.app = app
+        # Bound per request so that self.send can be handed straight to the app as an
+        # ASGI send callable.
+        self._send = send
+        self.method = method
+        self.as_html = as_html
         self.started = False
-        self.template = template
-        self.extra_template_data = extra_template_data
+        self.render_index = render_index
         self.rendered_routes_js = rendered_routes_js
+        self.routes_url = routes_url
         self.body = None
 
-    async def send(
-        self,
-        message: starlette.types.Message,
-        send: starlette.types.Send,
-        request: starlette.requests.Request,
-        as_html: bool = False,
-    ) -> None:
+    async def send(self, message: starlette.types.Message) -> None:
         """
         Wrap the processing of the request/response with the inertia protocol.
 
         This function is where most of the magic happens.
         """
+        send = self._send
+        as_html = self.as_html
         # Update redirect to set 303 status code.
         #
         # 409 conflict responses are only sent for GET requests, and not for
@@ -222,39 +571,56 @@ class InertiaResponder:
         #
         # Returning a 303 ensures that the browser follows with a GET, while a 302
         # doesn't necessarily guarantee it.
-        if "headers" not in message:
-            message["headers"] = []
-        headers = starlette.datastructures.MutableHeaders(scope=message)
         if message["type"] == "http.response.start":
-            if (
-                request.method in {"PUT", "PATCH", "DELETE"}
-                and message["status"] == 302
-            ):
-                # TODO does this work?
-                headers["Location"] = headers.get("Location")
+            if self.method in _REDIRECT_METHODS and message["status"] == 302:
+                # Only the status changes, so pass the headers through untouched. The
+                # body isn't rewritten either, so let it stream straight through.
+                self.started = True
                 await send(
                     {
                         "type": message["type"],
                         "status": 303,
-                        "headers": headers.raw,
+                        "headers": message.get("headers") or [],
                     }
                 )
             else:
-                headers["X-Inertia"] = "true"
+                # Build the new header list in one pass and only assign it once, noting
+                # the headers that decide what else gets added along the way.
+                replaced = (
+                    _REPLACED_HTML_RESPONSE_HEADERS
+                    if as_html
+                    else _REPLACED_RESPONSE_HEADERS
+                )
+                new_headers = []
+                has_cache_control = False
+                has_partial = False
+                vary_index = None
+                for key, value in message.get("headers") or ():
+                    if key in replaced:
+                        continue
+                    if key == b"cache-control":
+                        has_cache_control = True
+                    elif key == b"vary":
+                        if vary_index is None:
+                            vary_index = len(new_headers)
+                    elif key in _PARTIAL_HEADERS:
+                        has_partial = True
+                    new_headers.append((key, value))
                 if as_html:
-                    headers["Content-Type"] = "text/html"
+                    new_headers.extend(_HTML_RESPONSE_HEADERS)
+                    # The HTML shell embeds the asset version, so browsers must not
+                    # reuse it without revalidating. Endpoints can still override this.
+                    if not has_cache_control:
+                        new_headers.append(_HTML_CACHE_CONTROL)
                 else:
-                    headers["Content-Type"] = "application/json"
-                    if not any(
-                        [
-                            x in headers
-                            for x in [
-                                "x-inertia-partial-data",
-                                "x-inertia-partial-component",
-                            ]
-                        ]
-                    ):
-                        headers.add_vary_header("Accept")
+                    new_headers.extend(_JSON_RESPONSE_HEADERS)
+                    if not has_partial:
+                        if vary_index is None:
+                            new_headers.append(_VARY_ACCEPT)
+                        else:
+                            vary = new_headers[vary_index][1] + b", Accept"
+                            new_headers[vary_index] = (b"vary", vary)
+                message["headers"] = new_headers
                 # Don't send the message until we can figure out what the content-length
                 # needs to be.
                 self.message = message
@@ -271,15 +637,19 @@ class InertiaResponder:
                     self.body += message.get("body", b"")
                 if more_body:
                     return
-                # TODO call provided callable if not None, pass in jinja context
                 # TODO should we only do this on 2xx?
-                template_context = {
-                    "body": self.body,
-                    "routes_script": self.rendered_routes_js,
-                }
-                template_context.update(self.extra_template_data)
-                message["body"] = self.template.render(**template_context).encode()
-                headers["Content-Length"] = str(len(message["body"]))
+                message["body"] = self.render_index(
+                    self.body, self.rendered_routes_js, self.routes_url
+                )
+            if not more_body:
+                # The whole body is known, so send its length with the start message
+                # rather than falling back to chunked encoding.
+                headers = self.message["headers"]
+                if not any(key == b"content-length" for key, _ in headers):
+                    content_length = str(len(message.get("body", b"")))
+                    headers.append(
+                        (b"content-length", content_length.encode("latin-1"))
+                    )
             self.started = True
             await send(self.message)
             await send(message)
@@ -1,16 +1,67 @@
+import hashlib
+import html
 import json
+import os
+import pathlib
 import re
-from typing import Any, Callable, Dict, Optional, Union
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
 
-import bs4
+import httpx
 import pytest
 import starlette.applications
 import starlette.responses
 import starlette.routing
 import starlette.testclient
+import starlette.types
+import starlette.websockets
 
 import starlette_inertia as target
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+BASE_HEADERS = {
+    "x-requested-with": "XMLHttpRequest",
+    "x-inertia": "true",
+    "x-inertia-version": "foo",
+}
+
+DATA_PAGE_RE = re.compile(r"<div[^>]*\bdata-page='([^']*)'")
+SCRIPT_RE = re.compile(r"<script([^>]*)>(.*?)</script>", re.DOTALL)
+SRC_RE = re.compile(r'\bsrc="([^"]*)"')
+
+PATHS_RE = re.compile(r"/(foo|bar)")
+
+
+def response_json(response: Any) -> Any:
+    return json_loads(response.content)
+
+
+def asgi_client(app: starlette.types.ASGIApp) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://testserver"
+    )
+
+
+def response_headers(response: Any) -> Dict[str, str]:
+    return {k.lower(): v for k, v in response.headers.items()}
+
+
+def canonical_json(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode()
+
+
+def page_json(props: Any) -> bytes:
+    return canonical_json(
+        {"component": "Test", "props": props, "version": "foo", "url": "/"}
+    )
+
 
 def index_handler(request: starlette.requests.Request) -> starlette.responses.Response:
     del request
@@ -26,9 +77,88 @@ def multi_component_handler(
     )
 
 
+def list_handler(request: starlette.requests.Request) -> starlette.responses.Response:
+    del request
+    return target.InertiaResponse([1, 2], component="Test")
+
+
+def none_handler(request: starlette.requests.Request) -> starlette.responses.Response:
+    del request
+    return target.InertiaResponse(None, component="Test")
+
+
+@pytest.fixture(scope="module")
+async def basic_client() -> AsyncIterator[httpx.AsyncClient]:
+    app = starlette.applications.Starlette(
+        debug=False,
+        routes=[
+            starlette.routing.Route("/", index_handler),
+        ],
+        middleware=[
+            starlette.middleware.Middleware(
+                target.InertiaMiddleware, asset_version="foo"
+            ),
+        ],
+    )
+    async with asgi_client(app) as client:
+        yield client
+
+
+@pytest.fixture(scope="module")
+async def inertia_client(
+    request: pytest.FixtureRequest,
+) -> AsyncIterator[httpx.AsyncClient]:
+    # Parametrized indirectly with the (handler, props_callback) pair to install.
+    handler, props_callback = request.param
+    app = starlette.applications.Starlette(
+        debug=False,
+        routes=[
+            starlette.routing.Route("/", handler),
+        ],
+        middleware=[
+            starlette.middleware.Middleware(
+                target.InertiaMiddleware,
+                asset_version="foo",
+                props_callback=props_callback,
+            ),
+        ],
+    )
+    async with asgi_client(app) as client:
+        yield client
+
+
+@pytest.fixture(scope="module")
+async def path_matching_client(
+    request: pytest.FixtureRequest,
+) -> AsyncIterator[httpx.AsyncClient]:
+    # Parametrized indirectly with the paths pattern to install.
+    app = starlette.applications.Starlette(
+        debug=False,
+        routes=[
+            starlette.routing.Route(path, index_handler)
+            for path in ("/foo", "/bar", "/baz")
+        ],
+        middleware=[
+            starlette.middleware.Middleware(
+                target.InertiaMiddleware,
+                asset_version="foo",
+                paths=request.param,
+            ),
+        ],
+    )
+    async with asgi_client(app) as client:
+        yield client
+
+
+@pytest.fixture(scope="module")
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.mark.anyio
 class TestMiddleware:
     @pytest.mark.parametrize(
-        "headers, url, expected_status, expected_html",
+        "request_headers, url, expected_status, expected_content_type",
         [
             # Regular 200, not AJAX so just passed through and the response is
             # embedded in the returned HTML object.
@@ -36,7 +166,7 @@ class TestMiddleware:
                 {},
                 "/",
                 200,
-                True,
+                "text/html",
             ],
             # Basic AJAX request, with a matching inertia verison. Should just get a
             # back a basic JSON object.
@@ -48,14 +178,14 @@ class TestMiddleware:
                 },
                 "/",
                 200,
-                False,
+                "application/json",
             ],
             # Unknown route
             [
                 {},
                 "/unknown",
                 404,
-                True,
+                "text/html",
             ],
             [
                 {
@@ -65,16 +195,17 @@ class TestMiddleware:
                 },
                 "/unknown",
                 404,
-                False,
+                "application/json",
             ],
-            # Basic AJAX request, but erroneously missing the inertia header.
+            # Basic AJAX request, but erroneously missing the inertia header. Error
+            # responses are returned as-is rather than as Inertia responses.
             [
                 {
                     "x-requested-with": "XMLHttpRequest",
                 },
                 "/",
                 400,
-                False,
+                "text/plain; charset=utf-8",
             ],
             [
                 {
@@ -83,7 +214,7 @@ class TestMiddleware:
                 },
                 "/",
                 400,
-                False,
+                "text/plain; charset=utf-8",
             ],
             # Basic AJAX request, with a non-matching inertia verison.
             # Should get 409 telling inertia to fetch the whole page fresh.
@@ -95,7 +226,7 @@ class TestMiddleware:
                 },
                 "/",
                 409,
-                False,
+                "text/plain; charset=utf-8",
             ],
             [
                 {
@@ -104,176 +235,289 @@ class TestMiddleware:
                 },
                 "/",
                 409,
-                False,
+                "text/plain; charset=utf-8",
             ],
         ],
+        ids=[
+            "html",
+            "json",
+            "html-not-found",
+            "json-not-found",
+            "missing-inertia-header",
+            "missing-inertia-header-with-version",
+            "version-mismatch",
+            "version-missing",
+        ],
     )
-    def test_basic(
+    async def test_basic(
         self,
-        headers: Dict[str, str],
+        basic_client: httpx.AsyncClient,
+        request_headers: Dict[str, str],
         url: str,
         expected_status: int,
-        expected_html: bool,
+        expected_content_type: str,
     ) -> None:
-        app = starlette.applications.Starlette(
-            debug=True,
-            routes=[
-                starlette.routing.Route("/", index_handler),
-            ],
-            middleware=[
-                starlette.middleware.Middleware(
-                    target.InertiaMiddleware, asset_version="foo"
-                ),
-            ],
-        )
-
-        client = starlette.testclient.TestClient(app)
-        response = client.get(url, headers=headers)
+        response = await basic_client.get(url, headers=request_headers)
         assert response.status_code == expected_status
-        if expected_html:
-            assert response.headers.get("Content-Type", None) == "text/html"
+        headers = response_headers(response)
+        assert headers["content-type"] == expected_content_type
+        if expected_status in {400, 409}:
+            assert "x-inertia" not in headers
         else:
-            assert response.headers.get("Content-Type", None) == "application/json"
-        assert response.headers.get("X-Inertia", None) == "true"
+            assert headers["x-inertia"] == "true"
 
-    def test_html(self) -> None:
+    async def test_html(self, basic_client: httpx.AsyncClient) -> None:
         # TODO add tests for custom templates
-        app = starlette.applications.Starlette(
-            debug=True,
-            routes=[
-                starlette.routing.Route("/", index_handler),
-            ],
-            middleware=[
-                starlette.middleware.Middleware(
-                    target.InertiaMiddleware, asset_version="foo"
-                ),
-            ],
-        )
-
-        client = starlette.testclient.TestClient(app)
-        response = client.get("/")
+        response = await basic_client.get("/")
         assert response.status_code == 200
-        assert response.headers.get("Content-Type", None) == "text/html"
-        soup = bs4.BeautifulSoup(response.text, "html.parser")
-        assert len(soup.body.find_all("div")) == 1
-        data = json.loads(soup.body.find_all("div")[0].get("data-page"))
+        headers = response_headers(response)
+        assert headers["content-type"] == "text/html"
+        assert headers["cache-control"] == "no-cache, no-store, must-revalidate"
+        assert headers["content-length"] == str(len(response.content))
+        assert len(DATA_PAGE_RE.findall(response.text)) == 1
+        match = DATA_PAGE_RE.search(response.text)
+        data = json_loads(html.unescape(match.group(1)))
         assert data.get("component", None) == "Test"
         assert data.get("version", None) == "foo"
         assert data.get("url", None) == "/"
         assert data.get("props", None) == {"foo": "bar"}
 
     @pytest.mark.parametrize(
-        "callback, extra_headers, expected",
+        "routes_js_url, mount_path",
         [
-            # No callable
-            [
-                None,
-                {},
-                {"foo": "bar"},
-            ],
-            # Callable adds bar
-            [
-                lambda x: {"bar": "foo"},
-                {},
-                {"foo": "bar", "bar": "foo"},
-            ],
-            # Callable overrides foo
-            [
-                lambda x: {"foo": "baz"},
-                {},
-                {"foo": "bar"},
-            ],
+            ["/_inertia/routes.js", ""],
+            # Mounted apps reference routes.js under the mount prefix
+            ["/_inertia/routes.js", "/sub"],
+            # Disabled, the routes script is inlined instead
+            [None, ""],
         ],
     )
-    def test_props_callback(
-        self,
-        callback: Optional[Callable[[starlette.requests.Request], Dict[str, Any]]],
-        extra_headers: Dict[str, str],
-        expected: Dict[str, Any],
+    async def test_routes_js(
+        self, routes_js_url: Optional[str], mount_path: str
     ) -> None:
         app = starlette.applications.Starlette(
-            debug=True,
+            debug=False,
             routes=[
-                starlette.routing.Route("/", index_handler),
+                starlette.routing.Route("/", index_handler, name="index"),
             ],
             middleware=[
                 starlette.middleware.Middleware(
                     target.InertiaMiddleware,
                     asset_version="foo",
-                    props_callback=callback,
+                    routes_js_url=routes_js_url,
                 ),
             ],
         )
+        if mount_path:
+            app = starlette.applications.Starlette(
+                debug=False,
+                routes=[starlette.routing.Mount(mount_path, app=app)],
+            )
 
-        client = starlette.testclient.TestClient(app)
-        headers = dict(
-            {
-                "x-requested-with": "XMLHttpRequest",
-                "x-inertia": "true",
-                "x-inertia-version": "foo",
-            },
-            **extra_headers
-        )
-        response = client.get("/", headers=headers)
-        assert response.status_code == 200
-        assert response.headers.get("Content-Type", None) == "application/json"
-        assert response.json() == {
-            "component": "Test",
-            "props": expected,
-            "version": "foo",
-            "url": "/",
-        }
+        async with asgi_client(app) as client:
+            response = await client.get(mount_path + "/")
+            assert response.status_code == 200
+            scripts = SCRIPT_RE.findall(response.text)
+            assert len(scripts) == 1
+            attrs, script = scripts[0]
+            if routes_js_url is None:
+                assert SRC_RE.search(attrs) is None
+                assert 'window.routes = {"index": "/"};' in script
+                return
+
+            src = html.unescape(SRC_RE.search(attrs).group(1))
+            assert src.startswith(mount_path + routes_js_url + "?v=")
+            response = await client.get(src)
+            assert response.status_code == 200
+            headers = response_headers(response)
+            assert headers["content-type"] == "application/javascript"
+            assert headers["cache-control"] == "public, max-age=31536000, immutable"
+            assert 'window.routes = {"index": "/"};' in response.text
+            etag = headers["etag"]
+            assert etag == '"{}"'.format(src.split("?v=")[1])
+
+            response = await client.get(src, headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.content == b""
+
+            # Unversioned and stale URLs are served, but must be revalidated
+            bare_url = mount_path + routes_js_url
+            for url in (bare_url, bare_url + "?v=stale"):
+                response = await client.get(url)
+                assert response.status_code == 200
+                assert response_headers(response)["cache-control"] == "no-cache"
+                assert 'window.routes = {"index": "/"};' in response.text
+
+            # Only GET and HEAD are served, other methods go through to the app
+            response = await client.post(src)
+            assert response.status_code == 404
+            assert "window.routes" not in response.text
 
     @pytest.mark.parametrize(
-        "extra_headers, expected",
+        "inertia_client, request_headers, expected",
         [
-            # Component matches, no partial headers
-            [
-                {},
-                {"foo": "bar", "bar": "baz", "baz": "foo"},
-            ],
+            pytest.param(
+                (index_handler, None),
+                BASE_HEADERS,
+                page_json({"foo": "bar"}),
+                id="no-callback",
+            ),
+            pytest.param(
+                (index_handler, lambda x: {"bar": "foo"}),
+                BASE_HEADERS,
+                page_json({"foo": "bar", "bar": "foo"}),
+                id="callback-adds-prop",
+            ),
+            # Props from the response take precedence over the callback
+            pytest.param(
+                (index_handler, lambda x: {"foo": "baz"}),
+                BASE_HEADERS,
+                page_json({"foo": "bar"}),
+                id="callback-does-not-override",
+            ),
+            pytest.param(
+                (multi_component_handler, None),
+                BASE_HEADERS,
+                page_json({"foo": "bar", "bar": "baz", "baz": "foo"}),
+                id="no-partial",
+            ),
             # Component matches, partial headers return only a single prop
-            [
+            pytest.param(
+                (multi_component_handler, None),
                 {
+                    **BASE_HEADERS,
                     "X-Inertia-Partial-Component": "Test",
                     "X-Inertia-Partial-Data": "foo",
                 },
-                {"foo": "bar"},
-            ],
+                page_json({"foo": "bar"}),
+                id="partial-single",
+            ),
             # Component matches, multiple props specified as csv
-            [
+            pytest.param(
+                (multi_component_handler, None),
                 {
+                    **BASE_HEADERS,
                     "X-Inertia-Partial-Component": "Test",
                     "X-Inertia-Partial-Data": "foo,bar",
                 },
-                {"foo": "bar", "bar": "baz"},
-            ],
+                page_json({"foo": "bar", "bar": "baz"}),
+                id="partial-csv",
+            ),
             # Component doesn't match, all props returned
-            [
+            pytest.param(
+                (multi_component_handler, None),
                 {
+                    **BASE_HEADERS,
                     "X-Inertia-Partial-Component": "Nomatch",
                     "X-Inertia-Partial-Data": "foo",
                 },
-                {"foo": "bar", "bar": "baz", "baz": "foo"},
-            ],
+                page_json({"foo": "bar", "bar": "baz", "baz": "foo"}),
+                id="partial-component-mismatch",
+            ),
             # Component matches, but no -Data header present
-            [
+            pytest.param(
+                (multi_component_handler, None),
                 {
+                    **BASE_HEADERS,
                     "X-Inertia-Partial-Component": "Test",
                 },
-                {"foo": "bar", "bar": "baz", "baz": "foo"},
-            ],
+                page_json({"foo": "bar", "bar": "baz", "baz": "foo"}),
+                id="partial-no-data",
+            ),
+            # Non-dict props are passed through untouched, even on partial reloads
+            pytest.param(
+                (list_handler, None),
+                BASE_HEADERS,
+                page_json([1, 2]),
+                id="list-props",
+            ),
+            pytest.param(
+                (list_handler, None),
+                {
+                    **BASE_HEADERS,
+                    "X-Inertia-Partial-Component": "Test",
+                    "X-Inertia-Partial-Data": "foo",
+                },
+                page_json([1, 2]),
+                id="list-props-partial",
+            ),
+            pytest.param(
+                (none_handler, None),
+                BASE_HEADERS,
+                page_json(None),
+                id="none-props",
+            ),
+        ],
+        indirect=["inertia_client"],
+        scope="module",
+    )
+    async def test_props(
+        self,
+        inertia_client: httpx.AsyncClient,
+        request_headers: Dict[str, str],
+        expected: bytes,
+    ) -> None:
+        response = await inertia_client.get("/", headers=request_headers)
+        assert response.status_code == 200
+        headers = response_headers(response)
+        assert headers["content-type"] == "application/json"
+        assert headers["content-length"] == str(len(response.content))
+        assert canonical_json(response_json(response)) == expected
+
+    @pytest.mark.parametrize(
+        "headers, expected, expected_calls",
+        [
+            # Full reload evaluates every lazy prop
+            pytest.param(
+                BASE_HEADERS,
+                {"foo": "bar", "bar": "baz"},
+                ["bar"],
+                id="full",
+            ),
+            # Partial reload only evaluates the requested lazy props
+            pytest.param(
+                {
+                    **BASE_HEADERS,
+                    "X-Inertia-Partial-Component": "Test",
+                    "X-Inertia-Partial-Data": "foo",
+                },
+                {"foo": "bar"},
+                [],
+                id="partial-skips-lazy",
+            ),
+            pytest.param(
+                {
+                    **BASE_HEADERS,
+                    "X-Inertia-Partial-Component": "Test",
+                    "X-Inertia-Partial-Data": "bar",
+                },
+                {"bar": "baz"},
+                ["bar"],
+                id="partial-evaluates-lazy",
+            ),
         ],
     )
-    def test_partial(
+    async def test_lazy_props(
         self,
-        extra_headers: Dict[str, str],
+        headers: Dict[str, str],
         expected: Dict[str, Any],
+        expected_calls: List[str],
     ) -> None:
+        calls = []
+
+        def bar() -> str:
+            calls.append("bar")
+            return "baz"
+
         app = starlette.applications.Starlette(
-            debug=True,
+            debug=False,
             routes=[
-                starlette.routing.Route("/", multi_component_handler),
+                starlette.routing.Route(
+                    "/",
+                    lambda x: target.InertiaResponse(
+                        {"foo": "bar", "bar": bar}, component="Test"
+                    ),
+                ),
             ],
             middleware=[
                 starlette.middleware.Middleware(
@@ -283,27 +527,51 @@ class TestMiddleware:
             ],
         )
 
-        client = starlette.testclient.TestClient(app)
-        headers = dict(
-            {
-                "x-requested-with": "XMLHttpRequest",
-                "x-inertia": "true",
-                "x-inertia-version": "foo",
-            },
-            **extra_headers
+        async with asgi_client(app) as client:
+            response = await client.get("/", headers=headers)
+            assert response.status_code == 200
+            assert response_json(response)["props"] == expected
+            assert calls == expected_calls
+
+    @pytest.mark.parametrize(
+        "response_headers, expected_vary",
+        [
+            # Accept is added to responses that don't vary on anything yet
+            [None, "Accept"],
+            # and appended to an existing Vary header
+            [{"Vary": "Cookie"}, "Cookie, Accept"],
+        ],
+    )
+    async def test_vary(
+        self,
+        response_headers: Optional[Dict[str, str]],
+        expected_vary: str,
+    ) -> None:
+        app = starlette.applications.Starlette(
+            debug=False,
+            routes=[
+                starlette.routing.Route(
+                    "/",
+                    lambda x: target.InertiaResponse(
+                        {"foo": "bar"}, component="Test", headers=response_headers
+                    ),
+                ),
+            ],
+            middleware=[
+                starlette.middleware.Middleware(
+                    target.InertiaMiddleware,
+                    asset_version="foo",
+                ),
+            ],
         )
-        response = client.get("/", headers=headers)
-        assert response.status_code == 200
-        assert response.headers.get("Content-Type", None) == "application/json"
-        assert response.json() == {
-            "component": "Test",
-            "props": expected,
-            "version": "foo",
-            "url": "/",
-        }
+
+        async with asgi_client(app) as client:
+            response = await client.get("/", headers=BASE_HEADERS)
+            assert response.status_code == 200
+            assert response.headers.get("Vary", None) == expected_vary
 
     @pytest.mark.parametrize(
-        "pattern, req_path, expected_status",
+        "path_matching_client, req_path, expected_status",
         [
             # No path regex, should match everything
             [None, "/foo", 409],
@@ -319,57 +587,411 @@ class TestMiddleware:
             # Bad path should still 404
             [r"/(foo|bar)", "/notfound", 404],
             # Precompiled regex should also work
-            [re.compile(r"/(foo|bar)"), "/foo", 409],
-            [re.compile(r"/(foo|bar)"), "/bar", 409],
-            [re.compile(r"/(foo|bar)"), "/baz", 200],
+            [PATHS_RE, "/foo", 409],
+            [PATHS_RE, "/bar", 409],
+            [PATHS_RE, "/baz", 200],
             # Bad path should still 404
-            [re.compile(r"/(foo|bar)"), "/notfound", 404],
+            [PATHS_RE, "/notfound", 404],
         ],
+        indirect=["path_matching_client"],
+        scope="module",
     )
-    def test_path_matching(
+    async def test_path_matching(
         self,
-        pattern: Optional[Union[str, re.Pattern]],
+        path_matching_client: httpx.AsyncClient,
         req_path: str,
         expected_status: int,
     ) -> None:
+        headers = {
+            "x-requested-with": "XMLHttpRequest",
+            "x-inertia": "true",
+            # No version, to force a 409 if the middleware matches
+        }
+        response = await path_matching_client.get(req_path, headers=headers)
+        assert response.status_code == expected_status
+
+    @pytest.mark.parametrize(
+        "ttl, expected_calls",
+        [
+            # Default TTL, version is only computed once for back-to-back requests
+            [1.0, 1],
+            # No caching, version is computed on every request
+            [0, 3],
+            # Cached until refreshed
+            [None, 1],
+        ],
+    )
+    async def test_asset_version_ttl(
+        self, ttl: Optional[float], expected_calls: int
+    ) -> None:
+        calls = []
+
+        def asset_version() -> str:
+            calls.append(None)
+            return "foo"
+
         app = starlette.applications.Starlette(
-            debug=True,
+            debug=False,
             routes=[
-                starlette.routing.Route(
-                    "/foo",
-                    lambda x: target.InertiaResponse({"foo": "bar"}, component="Test"),
+                starlette.routing.Route("/", index_handler),
+            ],
+            middleware=[
+                starlette.middleware.Middleware(
+                    target.InertiaMiddleware,
+                    asset_version=asset_version,
+                    asset_version_ttl=ttl,
+                ),
+            ],
+        )
+
+        async with asgi_client(app) as client:
+            for _ in range(3):
+                response = await client.get("/", headers=BASE_HEADERS)
+                assert response.status_code == 200
+                assert response_json(response)["version"] == "foo"
+            assert len(calls) == expected_calls
+
+    @pytest.mark.parametrize(
+        "asset_version, client_version, expected_status",
+        [
+            # Non-latin-1 versions are compared as utf-8
+            ["v\u20ac", "v\u20ac".encode("utf-8"), 200],
+            ["v\u20ac", b"foo", 409],
+            # Non-str versions are compared by their str() form
+            [lambda: 5, b"5", 200],
+            [lambda: 5, b"6", 409],
+        ],
+    )
+    async def test_version_encoding(
+        self,
+        asset_version: Any,
+        client_version: bytes,
+        expected_status: int,
+    ) -> None:
+        app = starlette.applications.Starlette(
+            debug=False,
+            routes=[
+                starlette.routing.Route("/", index_handler),
+            ],
+            middleware=[
+                starlette.middleware.Middleware(
+                    target.InertiaMiddleware, asset_version=asset_version
                 ),
+            ],
+        )
+
+        async with asgi_client(app) as client:
+            headers = {**BASE_HEADERS, "x-inertia-version": client_version}
+            response = await client.get("/", headers=headers)
+            assert response.status_code == expected_status
+
+    @pytest.mark.parametrize(
+        "index_cache_size, expected_hits",
+        [
+            # Repeat loads of an identical page are served from the cache
+            [512, 1],
+            # Caching disabled
+            [0, 0],
+        ],
+    )
+    async def test_index_cache(self, index_cache_size: int, expected_hits: int) -> None:
+        versions = ["foo"]
+        inner_app = starlette.applications.Starlette(
+            debug=False,
+            routes=[
+                starlette.routing.Route("/", index_handler),
+            ],
+        )
+        middleware = target.InertiaMiddleware(
+            inner_app,
+            asset_version=lambda: versions[-1],
+            asset_version_ttl=0,
+            index_cache_size=index_cache_size,
+        )
+
+        async def app(
+            scope: starlette.types.Scope,
+            receive: starlette.types.Receive,
+            send: starlette.types.Send,
+        ) -> None:
+            # Set by Starlette before its middleware stack runs.
+            scope["app"] = inner_app
+            await middleware(scope, receive, send)
+
+        async with asgi_client(app) as client:
+            first = await client.get("/")
+            second = await client.get("/")
+            assert first.content == second.content
+            cache_info = middleware._render_index.cache_info()
+            assert cache_info.hits == expected_hits
+            assert cache_info.currsize == min(index_cache_size, 1)
+
+            # A new asset version clears the cache, and the page carries it.
+            versions.append("bar")
+            response = await client.get("/")
+            match = DATA_PAGE_RE.search(response.text)
+            assert json_loads(html.unescape(match.group(1)))["version"] == "bar"
+            assert middleware._render_index.cache_info().hits == 0
+
+    def test_refresh_version(self) -> None:
+        versions = iter(["foo", "bar"])
+        middleware = target.InertiaMiddleware(
+            starlette.applications.Starlette(),
+            asset_version=lambda: next(versions),
+            asset_version_ttl=None,
+        )
+        assert middleware._inertia_version == "foo"
+        assert middleware._inertia_version == "foo"
+        middleware.refresh_version()
+        assert middleware._inertia_version == "bar"
+
+    @pytest.mark.parametrize(
+        "method, expected_status",
+        [
+            ["GET", 302],
+            ["POST", 302],
+            # Non-POST mutations are redirected with a 303 so the browser follows
+            # with a GET.
+            ["PUT", 303],
+            ["PATCH", 303],
+            ["DELETE", 303],
+        ],
+    )
+    async def test_redirect(self, method: str, expected_status: int) -> None:
+        app = starlette.applications.Starlette(
+            debug=False,
+            routes=[
                 starlette.routing.Route(
-                    "/bar",
-                    lambda x: target.InertiaResponse({"foo": "bar"}, component="Test"),
+                    "/",
+                    lambda x: starlette.responses.RedirectResponse(
+                        "/foo", status_code=302
+                    ),
+                    methods=["GET", "POST", "PUT", "PATCH", "DELETE"],
                 ),
+            ],
+            middleware=[
+                starlette.middleware.Middleware(
+                    target.InertiaMiddleware, asset_version="foo"
+                ),
+            ],
+        )
+
+        async with asgi_client(app) as client:
+            response = await client.request(
+                method, "/", headers=BASE_HEADERS, follow_redirects=False
+            )
+            assert response.status_code == expected_status
+            assert response.headers.get("Location", None) == "/foo"
+
+    @pytest.mark.parametrize(
+        "prefix, static_prefix, req_path, expected_status",
+        [
+            # No prefix, everything goes through the middleware
+            [None, None, "/app", 409],
+            [None, None, "/static", 409],
+            # Single prefix
+            ["/app", None, "/app", 409],
+            ["/app", None, "/static", 200],
+            # Multiple prefixes
+            [("/app", "/admin"), None, "/app", 409],
+            [("/app", "/admin"), None, "/admin", 409],
+            [("/app", "/admin"), None, "/static", 200],
+            # Static prefix is skipped, everything else goes through
+            [None, "/static", "/app", 409],
+            [None, "/static", "/static", 200],
+            [None, ("/assets", "/static"), "/static", 200],
+        ],
+    )
+    async def test_path_prefix(
+        self,
+        prefix: Optional[Union[str, Tuple[str, ...]]],
+        static_prefix: Optional[Union[str, Tuple[str, ...]]],
+        req_path: str,
+        expected_status: int,
+    ) -> None:
+        app = starlette.applications.Starlette(
+            debug=False,
+            routes=[
+                starlette.routing.Route("/app", index_handler),
+                starlette.routing.Route("/admin", index_handler),
                 starlette.routing.Route(
-                    "/baz",
-                    lambda x: target.InertiaResponse({"foo": "bar"}, component="Test"),
+                    "/static", lambda x: starlette.responses.PlainTextResponse("foo")
                 ),
             ],
             middleware=[
                 starlette.middleware.Middleware(
                     target.InertiaMiddleware,
                     asset_version="foo",
-                    paths=pattern,
+                    path_prefix=prefix,
+                    static_prefix=static_prefix,
+                ),
+            ],
+        )
+
+        async with asgi_client(app) as client:
+            headers = {
+                "x-requested-with": "XMLHttpRequest",
+                "x-inertia": "true",
+                # No version, to force a 409 if the middleware matches
+            }
+            response = await client.get(req_path, headers=headers)
+            assert response.status_code == expected_status
+            if expected_status == 200:
+                assert "X-Inertia" not in response.headers
+
+    async def test_mount(self) -> None:
+        sub_app = starlette.applications.Starlette(
+            debug=False,
+            routes=[
+                starlette.routing.Route("/x", index_handler),
+            ],
+            middleware=[
+                starlette.middleware.Middleware(
+                    target.InertiaMiddleware,
+                    asset_version="foo",
+                    path_prefix="/sub/x",
                 ),
             ],
         )
+        app = starlette.applications.Starlette(
+            debug=False,
+            routes=[starlette.routing.Mount("/sub", app=sub_app)],
+        )
+
+        # The mount prefix is part of the page url, exactly once.
+        async with asgi_client(app) as client:
+            response = await client.get("/sub/x", headers=BASE_HEADERS)
+            assert response.status_code == 200
+            assert response_headers(response)["x-inertia"] == "true"
+            assert response_json(response)["url"] == "/sub/x"
+
+            response = await client.get("/sub/x")
+            assert response.status_code == 200
+            match = DATA_PAGE_RE.search(response.text)
+            assert json_loads(html.unescape(match.group(1)))["url"] == "/sub/x"
 
+    def test_websocket(self) -> None:
+        async def websocket_handler(websocket: starlette.websockets.WebSocket) -> None:
+            await websocket.accept()
+            await websocket.send_text("foo")
+            await websocket.close()
+
+        app = starlette.applications.Starlette(
+            debug=False,
+            routes=[
+                starlette.routing.WebSocketRoute("/ws", websocket_handler),
+            ],
+            middleware=[
+                starlette.middleware.Middleware(
+                    target.InertiaMiddleware, asset_version="foo"
+                ),
+            ],
+        )
+
+        # Non-http scopes are passed straight through to the app.
         client = starlette.testclient.TestClient(app)
-        headers = {
-            "x-requested-with": "XMLHttpRequest",
-            "x-inertia": "true",
-            # No version, to force a 409 if the middleware matches
+        with client.websocket_connect("/ws") as websocket:
+            assert websocket.receive_text() == "foo"
+
+    @pytest.mark.parametrize(
+        "mount_path, url, expected_location",
+        [
+            ["", "/", "/"],
+            ["", "/?foo=bar", "/?foo=bar"],
+            ["", "/foo%20bar?baz=1&qux=2", "/foo%20bar?baz=1&qux=2"],
+            # Escaped delimiters stay escaped
+            ["", "/files/a%2Fb", "/files/a%2Fb"],
+            # The mount prefix is included exactly once
+            ["/sub", "/sub/x?foo=bar", "/sub/x?foo=bar"],
+        ],
+    )
+    async def test_location(
+        self,
+        mount_path: str,
+        url: str,
+        expected_location: str,
+    ) -> None:
+        app = starlette.applications.Starlette(
+            debug=False,
+            routes=[
+                starlette.routing.Route("/", index_handler),
+            ],
+            middleware=[
+                starlette.middleware.Middleware(
+                    target.InertiaMiddleware, asset_version="foo"
+                ),
+            ],
+        )
+        if mount_path:
+            app = starlette.applications.Starlette(
+                debug=False,
+                routes=[starlette.routing.Mount(mount_path, app=app)],
+            )
+
+        async with asgi_client(app) as client:
+            headers = {**BASE_HEADERS, "x-inertia-version": "bar"}
+            response = await client.get(url, headers=headers)
+            assert response.status_code == 409
+            assert response.text == "Inertia version does not match"
+            location = response_headers(response)["x-inertia-location"]
+            assert location == expected_location
+
+    async def test_location_crlf(self) -> None:
+        app = starlette.applications.Starlette(
+            debug=False,
+            routes=[
+                starlette.routing.Route("/", index_handler),
+            ],
+        )
+        middleware = target.InertiaMiddleware(app, asset_version="foo")
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "scheme": "http",
+            "server": ("testserver", 80),
+            "path": "/",
+            "root_path": "",
+            "query_string": b"a=b\r\nx-injected: true",
+            "headers": [
+                (b"x-requested-with", b"XMLHttpRequest"),
+                (b"x-inertia", b"true"),
+            ],
+            "app": app,
         }
-        response = client.get(req_path, headers=headers)
-        assert response.status_code == expected_status
+        messages = []
+
+        async def receive() -> Dict[str, Any]:
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message: Dict[str, Any]) -> None:
+            messages.append(message)
+
+        await middleware(scope, receive, send)
+        assert messages[0]["status"] == 409
+        headers = dict(messages[0]["headers"])
+        assert headers[b"x-inertia-location"] == b"/?a=bx-injected: true"
+
+
+def test_manifest_version(tmp_path: pathlib.Path) -> None:
+    manifest = tmp_path / "manifest.json"
+    manifest.write_bytes(b"foo")
+    version = target.manifest_version(manifest)
+    assert version() == hashlib.md5(b"foo").hexdigest()
+
+    # Unchanged mtime, the cached hash is reused even if the contents differ
+    stat = os.stat(manifest)
+    manifest.write_bytes(b"bar")
+    os.utime(manifest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert version() == hashlib.md5(b"foo").hexdigest()
+
+    # New mtime, the file is rehashed
+    os.utime(manifest, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert version() == hashlib.md5(b"bar").hexdigest()
+
+    version = target.manifest_version(manifest, hasher=hashlib.sha1)
+    assert version() == hashlib.sha1(b"bar").hexdigest()
 
 
 # TODO add test that asserts that passed templates are rendered correctly
 
 # TODO add test that assert the structure of the returned JSON objects.
-
-# TODO add tests that assert that the returned X-Inertia-Location header on 409s is
-# correct.